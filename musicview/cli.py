@@ -14,28 +14,37 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import re
 import sys
 import urllib.error
 import urllib.request
 from curses import wrapper
 from functools import partial
+from http.client import HTTPException
 from os import getenv
 from pathlib import Path
 from shutil import which
-from sqlite3 import connect
+from socket import timeout
+from threading import Thread
+from typing import Optional, Tuple
 
 import click
 import toml
 
 from .__version__ import __title__, __version__
-from .db import init_db, update_db
+from .db import close_db, connect_db, init_db, update_db
+from .misc import cached_formats
 from .player import Player
 
 DEFAULT_CONFIG_HOME = Path.home() / '.musicview'
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 CONFIG_ENVAR = 'MUSICVIEW_CONFIG_HOME'
+SCAN_WORKERS_ENVAR = 'MUSICVIEW_SCAN_WORKERS'
 CONF_FILE = 'musicview.toml'
+UPDATE_CACHE = '.update_cache.json'
+FORMATS_CACHE = '.ffplay_formats.json'
+VERSION_RE = re.compile(r"__version__\s*=\s*'(.*)'")
 
 print = click.echo
 fprint = partial(click.echo, file=sys.stderr)
@@ -57,20 +66,25 @@ class Ctx:
         },
         'library paths': {}
     }
+    config_cache = {}
 
     def __init__(self):
         ffplay = which('ffplay')
-        ffmpeg = which('ffmpeg')
-        if not ffplay or not ffmpeg:
-            exit('ffmpeg/ffplay not found!')
+        ffprobe = which('ffprobe')
+        if not ffplay or not ffprobe:
+            exit('ffprobe/ffplay not found!')
         self.ffplay = ffplay
-        self.ffmpeg = ffmpeg
+        self.ffprobe = ffprobe
         self.config_home = Path(getenv(CONFIG_ENVAR, DEFAULT_CONFIG_HOME)).expanduser()
         if not (self.config_home / CONF_FILE).is_file():
             self.setup()
-        self.config = toml.loads((self.config_home / CONF_FILE).read_text())
+        self.config = self.load_config()
+        self.conns = {}
+        self.update_check = None
+        self.update_result = None
         if self.config['general']['check for updates']:
-            check_update()
+            self.update_check = Thread(target=self.run_update_check, daemon=True)
+            self.update_check.start()
 
     def setup(self):
         """Prompt the user to do some initial setup"""
@@ -95,18 +109,49 @@ class Ctx:
         print(f'Configuration file has been generated at '
               f'{self.config_home / CONF_FILE}')
 
+    def load_config(self):
+        """
+        Load the config file, reusing the last parsed config
+        if the file hasn't changed since
+
+        Returns:
+            the config dict
+        """
+        conf_file = self.config_home / CONF_FILE
+        stat = conf_file.stat()
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached_key, config = self.config_cache.get(conf_file, (None, None))
+        if cached_key != key:
+            config = toml.loads(conf_file.read_text())
+            self.config_cache[conf_file] = (key, config)
+        return config
+
     def dump_config(self, cfg):
         """
         Dump a config dict
         Args:
             cfg: The config to dump
         """
+        self.config_cache.pop(self.config_home / CONF_FILE, None)
         with (self.config_home / CONF_FILE).open('w+') as f:
             try:
                 toml.dump(cfg, f)
             except OSError as e:
                 exit(e)
 
+    @property
+    def scan_workers(self):
+        """Number of directories to scan at once, only read by commands that scan"""
+        try:
+            return int(getenv(SCAN_WORKERS_ENVAR, 1))
+        except ValueError:
+            exit(f'{SCAN_WORKERS_ENVAR} must be an integer!')
+
+    @property
+    def formats(self):
+        """Formats supported by ffplay"""
+        return cached_formats(self.ffplay, self.config_home / FORMATS_CACHE)
+
     def get_libpath(self, name):
         """
         Get library path by name
@@ -127,9 +172,8 @@ class Ctx:
         Returns:
             if the library exists
         """
-        return name in map(
-            lambda p: p.name.replace('.db', ''), self.config_home.iterdir()
-        ) and name in self.config['library paths']
+        libs = self.config['library paths']
+        return name in libs and (self.config_home / f'{name}.db').is_file()
 
     def delete_lib(self, name):
         """
@@ -153,50 +197,113 @@ class Ctx:
 
     def get_conn(self, name):
         """
-        Get a sqlite3 connection
+        Get a sqlite3 connection, reused for the lifetime of this context
         Args:
             name: name of the library
 
         Returns:
             the connection
         """
-        return connect(str(self.config_home / f'{name}.db'))
+        conn = self.conns.get(name)
+        if conn is None:
+            conn = connect_db(self.config_home / f'{name}.db', check_same_thread=False)
+            self.conns[name] = conn
+        return conn
+
+    def run_update_check(self):
+        """Check for updates and keep the result, meant to be ran in another thread"""
+        self.update_result = check_update(self.config_home / UPDATE_CACHE)
+
+    def report_update(self):
+        """
+        Show the update check's message and store its cache, from the main thread
+        once the command is done. Dropped if the check hasn't finished shortly after.
+        """
+        if not self.update_check:
+            return
+        self.update_check.join(timeout=0.2)
+        if self.update_result is None:
+            return
+        message, cache = self.update_result
+        if cache:
+            try:
+                (self.config_home / UPDATE_CACHE).write_text(json.dumps(cache))
+            except OSError:
+                pass
+        if message:
+            print(message)
+
+    def close_conns(self):
+        """Close all opened sqlite3 connections"""
+        for conn in self.conns.values():
+            close_db(conn)
+        self.conns.clear()
 
 
 pass_context = click.make_pass_decorator(Ctx, ensure=True)
 
 
-def check_update():
-    """Check for updates"""
+def check_update(cache_file: Path) -> Tuple[Optional[str], Optional[dict]]:
+    """
+    Check for updates, meant to be ran in another thread.
+    The last seen version and its ETag are cached so an unchanged
+    version file isn't downloaded again.
+    Nothing is printed or written here, the caller does both.
+    Args:
+        cache_file: path to the update check cache
+    Returns:
+        The message to show if any, and the new cache content to store if any
+    """
     url = ('https://raw.githubusercontent.com'
            '/MaT1g3R/musicview/master/musicview/__version__.py')
     try:
-        with urllib.request.urlopen(url) as resp:
+        cache = json.loads(cache_file.read_text())
+    except (OSError, ValueError):
+        cache = {}
+    # A 304 is only usable if the cache also knows which version that ETag was for
+    if 'etag' in cache and 'version' in cache:
+        headers = {'If-None-Match': cache['etag']}
+    else:
+        headers = {}
+    try:
+        req = urllib.request.Request(url, headers=headers)
+        with urllib.request.urlopen(req, timeout=2.0) as resp:
             text = resp.read().decode()
-    except urllib.error.URLError:
-        print('Could not check for updates, '
-              'are you connected to the internet?')
+            etag = resp.headers.get('ETag')
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            return 'Could not check for updates.', None
+        head_version = cache['version']
+        new_cache = None
+    except (urllib.error.URLError, timeout):
+        return 'Could not check for updates, are you connected to the internet?', None
+    except (OSError, HTTPException):
+        return 'Could not check for updates.', None
     else:
-        regex = re.compile(r"__version__[\s]*=[\s]*\'(.*)\'")
-        head_version = regex.findall(text)[0]
-        t = lambda s: tuple(map(int, s.split('.')))
-        if t(head_version) > t(__version__):
-            print(f'New version ({head_version}) available!')
+        head_version = next(iter(VERSION_RE.findall(text)), None)
+        new_cache = {'etag': etag, 'version': head_version} if etag else None
+    t = lambda s: tuple(map(int, s.split('.')))
+    try:
+        newer = t(head_version) > t(__version__)
+    except (AttributeError, ValueError):
+        # No version in the response, e.g. a captive portal page, or one we can't compare
+        return 'Could not check for updates.', None
+    if newer:
+        return f'New version ({head_version}) available!', new_cache
+    return None, new_cache
 
 
-def play_music(data, name, conn, ffplay, controls, stdscr):
+def play_music(conn, ffplay, controls, stdscr):
     """
     Play some music!
     Args:
-        data: path to the dirctory containg database files
-        name: name of the music library
         conn: database connection
         ffplay: ffplay binary
         controls: curses controls keymap
         stdscr: curses screen
     """
     stdscr.clear()
-    player = Player(data, name, ffplay, conn, controls, stdscr)
+    player = Player(ffplay, conn, controls, stdscr)
     player.start()
 
 
@@ -204,7 +311,10 @@ def play_music(data, name, conn, ffplay, controls, stdscr):
 @pass_context
 def cli(ctx):
     """musicview, (re)discover your music library"""
-    pass
+    # Callbacks run after the command returns, so never while curses owns the screen
+    click_ctx = click.get_current_context()
+    click_ctx.call_on_close(ctx.close_conns)
+    click_ctx.call_on_close(ctx.report_update)
 
 
 @click.command(name='list')
@@ -228,7 +338,7 @@ def play(ctx, name):
         exit(f'Library "{name}" does not exist!')
     controls = {val: key for key, val in ctx.config['player control'].items()}
     with ctx.get_conn(name) as conn:
-        wrapper(partial(play_music, ctx.config_home, name, conn, ctx.ffplay, controls))
+        wrapper(partial(play_music, conn, ctx.ffplay, controls))
 
 
 @click.command()
@@ -256,7 +366,7 @@ def update(ctx, name: str):
     if not ctx.library_exists(name):
         exit(f'Library "{name}" does not exist!')
     with ctx.get_conn(name) as conn:
-        update_db(ctx.get_libpath(name), conn, ctx.ffmpeg, ctx.ffplay)
+        update_db(ctx.get_libpath(name), conn, ctx.ffprobe, ctx.formats, ctx.scan_workers)
 
 
 @click.command(short_help='Create a new music library')
@@ -279,7 +389,7 @@ def new(ctx, name, path):
     if not path.is_dir():
         exit(f'Path {path} is not a valid direcory.')
     init_db(
-        path, ctx.config_home / f'{name}.db', ctx.ffmpeg, ctx.ffplay
+        path, ctx.config_home / f'{name}.db', ctx.ffprobe, ctx.formats, ctx.scan_workers
     )
     ctx.new_lib(name, str(path))
 
@@ -14,98 +14,257 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
-from itertools import chain
+from itertools import islice
+from os import cpu_count
 from pathlib import Path
-from sqlite3 import Connection, connect
-from typing import Iterator
+from random import randrange
+from sqlite3 import Connection, connect, sqlite_version_info
+from typing import Iterator, Optional
 
 import click
 from click import progressbar
 
-from .misc import get_songs, get_supported_formats
+from .misc import get_songs, get_songs_parallel
 from .song import MetaData, Song
 
+HAS_RETURNING = sqlite_version_info >= (3, 35, 0)
+CHUNK_SIZE = 1024
+SCAN_THREADS = min(32, (cpu_count() or 1) * 4)
 
-def update_db(path: Path, conn: Connection, ffmpeg: str, ffplay: str):
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS library (
+path VARCHAR PRIMARY KEY,
+title VARCHAR,
+genre VARCHAR,
+artist VARCHAR,
+album VARCHAR,
+length REAL,
+favourite BOOLEAN DEFAULT 0 NOT NULL,
+listen_count INT DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_library_listen_count ON library(listen_count);
+"""
+
+if sqlite_version_info >= (3, 24, 0):
+    UPSERT_SQL = """
+    INSERT INTO library (path, title, genre, artist, album, length)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (path) DO UPDATE SET
+    title = excluded.title,
+    genre = excluded.genre,
+    artist = excluded.artist,
+    album = excluded.album,
+    length = excluded.length;
+    """
+else:
+    # No UPSERT before sqlite 3.24, carry over favourite and listen_count by hand
+    UPSERT_SQL = """
+    INSERT OR REPLACE INTO library
+    (path, title, genre, artist, album, length, favourite, listen_count)
+    VALUES (
+    ?1, ?2, ?3, ?4, ?5, ?6,
+    COALESCE((SELECT favourite FROM library WHERE path = ?1), 0),
+    COALESCE((SELECT listen_count FROM library WHERE path = ?1), 0)
+    );
+    """
+
+
+def update_db(path: Path, conn: Connection, ffprobe: str, formats, workers: int = 1):
     """
     Update the database
     Args:
         path: path to the music library
         conn: database connection
-        ffmpeg: ffmpeg binary
-        ffplay: ffplay binary
+        ffprobe: ffprobe binary
+        formats: set of supported audio formats
+        workers: number of directories to scan at once
     """
-    formats = set(get_supported_formats(ffplay))
+    # Also brings libraries created by older versions up to date, e.g. new indexes
+    conn.executescript(SCHEMA_SQL)
     click.echo('Fetching songs...')
-    songs = set(map(str, get_songs(path, formats)))
-    if not songs:
-        exit(f'Could not find any music files under "{path}"!')
-
+    if workers > 1:
+        songs = get_songs_parallel(path, formats, workers)
+    else:
+        songs = get_songs(path, formats)
     with cursor(conn) as cur:
         cur.execute('CREATE TEMP TABLE tmp (path VARCHAR PRIMARY KEY);')
-        cur.executemany('INSERT INTO tmp(path) VALUES (?);', ((s,) for s in songs))
-        cur.execute('DELETE FROM library WHERE path NOT IN (SELECT path FROM tmp);')
-        cur.execute('DROP TABLE tmp;')
-
-        with progressbar(songs, label='Updating database...') as bar:
-            for song in bar:
-                metadata = MetaData.from_path(ffmpeg, song)
-                if not metadata:
-                    continue
-                assert metadata.length
-                cur.execute('SELECT * FROM library WHERE path=?', (metadata.path,))
-                if not cur.fetchone():
-                    cur.execute(
-                        """
-                        INSERT INTO library (path, title, genre, artist, album, length)
-                        VALUES (?, ?, ?, ?, ?, ?);
-                        """, metadata
-                    )
-                else:
-                    cur.execute(
-                        """
-                        UPDATE library SET
-                        title = ?,
-                        genre = ?,
-                        artist = ?,
-                        album = ?,
-                        length = ?
-                        WHERE path=?;
-                        """, tuple(chain(metadata[1:], metadata[:1]))
-                    )
-        conn.commit()
+        try:
+            with transaction(conn):
+                cur.executemany(
+                    'INSERT OR IGNORE INTO tmp(path) VALUES (?);',
+                    ((s,) for s in songs)
+                )
+                cur.execute('SELECT count(*) FROM tmp;')
+                count, = cur.fetchone()
+                if not count:
+                    exit(f'Could not find any music files under "{path}"!')
+                cur.execute('DELETE FROM library WHERE path NOT IN (SELECT path FROM tmp);')
+                paths = (p for p, in conn.execute('SELECT path FROM tmp;'))
+                cur.executemany(UPSERT_SQL, song_metadata(ffprobe, paths, count))
+                cur.execute('ANALYZE;')
+        finally:
+            cur.execute('DROP TABLE tmp;')
+
+
+def chunked(iterable, n: int) -> Iterator[list]:
+    """
+    Split an iterable into lists of at most n items
+
+    Args:
+        iterable: the iterable to split
+        n: maximum size of each list
+
+    Returns:
+        A generator of lists
+    """
+    it = iter(iterable)
+    batch = list(islice(it, n))
+    while batch:
+        yield batch
+        batch = list(islice(it, n))
+
+
+def scan_library(ffprobe: str, paths) -> Iterator[Optional[MetaData]]:
+    """
+    Probe songs in a thread pool, since most of the time is spent
+    waiting on file reads and ffprobe subprocesses. Paths are submitted
+    one chunk at a time to keep the number of pending futures bounded.
+
+    Args:
+        ffprobe: ffprobe binary
+        paths: paths to the songs
 
+    Returns:
+        A generator of song metadata in completion order,
+        None for songs without a length
+    """
+    with ThreadPoolExecutor(max_workers=SCAN_THREADS) as pool:
+        for batch in chunked(paths, CHUNK_SIZE):
+            futures = [pool.submit(MetaData.from_path, ffprobe, path) for path in batch]
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                # Closed early (Ctrl-C, a failed insert), don't wait on the queued probes
+                for future in futures:
+                    future.cancel()
+
+
+def song_metadata(ffprobe: str, songs, count: int) -> Iterator[MetaData]:
+    """
+    Get the metadata of songs, skipping the ones without a length.
+
+    Args:
+        ffprobe: ffprobe binary
+        songs: paths to the songs
+        count: number of songs, for the progress bar
+
+    Returns:
+        A generator of song metadata
+    """
+    with progressbar(length=count, label='Updating database...') as bar:
+        for metadata in scan_library(ffprobe, songs):
+            bar.update(1)
+            if not metadata:
+                continue
+            assert metadata.length
+            yield metadata
 
-def init_db(path: Path, db_path: Path, ffmpeg: str, ffplay: str):
+
+def init_db(path: Path, db_path: Path, ffprobe: str, formats, workers: int = 1):
     """
     Initialize the database
 
     Args:
         path: path to the music directory
         db_path: path to the database
-        ffmpeg: ffmpeg binary
-        ffplay: ffplay binary
+        ffprobe: ffprobe binary
+        formats: set of supported audio formats
+        workers: number of directories to scan at once
     """
     db_path.touch()
 
-    with connect(str(db_path)) as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS library (
-            path VARCHAR PRIMARY KEY,
-            title VARCHAR,
-            genre VARCHAR,
-            artist VARCHAR,
-            album VARCHAR,
-            length REAL,
-            favourite BOOLEAN DEFAULT 0 NOT NULL,
-            listen_count INT DEFAULT 0
-            );
-            """
-        )
+    with get_connection(db_path) as conn:
+        update_db(path, conn, ffprobe, formats, workers)
+
+
+def _tune(conn: Connection):
+    """
+    Apply the PRAGMAs used for every library database connection
+
+    Args:
+        conn: The db connection
+    """
+    conn.execute('PRAGMA journal_mode=WAL;')
+    conn.execute('PRAGMA synchronous=NORMAL;')
+    conn.execute('PRAGMA temp_store=MEMORY;')
+    conn.execute('PRAGMA cache_size=-64000;')
+    conn.execute('PRAGMA mmap_size=268435456;')
+
+
+def connect_db(db_path: Path, **kwargs) -> Connection:
+    """
+    Open a tuned db connection
+
+    Args:
+        db_path: path to the database
+        **kwargs: extra arguments for sqlite3.connect
+
+    Returns:
+        the connection
+    """
+    conn = connect(str(db_path), **kwargs)
+    _tune(conn)
+    return conn
+
+
+def close_db(conn: Connection):
+    """
+    Let sqlite update its statistics if needed, then close a db connection
+
+    Args:
+        conn: The db connection
+    """
+    conn.execute('PRAGMA optimize;')
+    conn.close()
+
+
+@contextmanager
+def get_connection(db_path: Path) -> Iterator[Connection]:
+    """
+    Contextmanager for a tuned db connection,
+    commits on success and closes the connection on exit
+
+    Args:
+        db_path: path to the database
+    """
+    conn = connect_db(db_path)
+    try:
+        with conn:
+            yield conn
+    finally:
+        close_db(conn)
+
+
+@contextmanager
+def transaction(conn):
+    """
+    Contextmanager for an explicit write transaction, taking the write lock
+    upfront with BEGIN IMMEDIATE. Commits on success, rolls back otherwise.
+
+    Args:
+        conn: The db connection
+    """
+    conn.execute('BEGIN IMMEDIATE;')
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
         conn.commit()
-        update_db(path, conn, ffmpeg, ffplay)
 
 
 @contextmanager
@@ -136,11 +295,25 @@ def next_song(conn, cur) -> Song:
     """
     cur.execute(
         """
-        SELECT * FROM library
-        WHERE listen_count=(SELECT min(listen_count) FROM library)
-        ORDER BY RANDOM() LIMIT 1
+        SELECT listen_count, count(*) FROM library
+        GROUP BY listen_count ORDER BY listen_count LIMIT 1
         """
     )
+    min_count, n_min = cur.fetchone()
+    pick = (min_count, randrange(n_min))
+    if HAS_RETURNING:
+        cur.execute(
+            """
+            UPDATE library SET
+            listen_count = listen_count + 1
+            WHERE path=(SELECT path FROM library WHERE listen_count=? LIMIT 1 OFFSET ?)
+            RETURNING *
+            """, pick
+        )
+        next, = cur.fetchall()
+        conn.commit()
+        return Song(MetaData(*next[:-2]), bool(next[-2]), next[-1])
+    cur.execute('SELECT * FROM library WHERE listen_count=? LIMIT 1 OFFSET ?', pick)
     next = cur.fetchone()
     cur.execute(
         """
@@ -14,11 +14,24 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import os
+import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
 from subprocess import DEVNULL, PIPE, run
 
 from typing import Optional
 
+try:
+    import av
+except ImportError:
+    av = None
+
+DEMUXER_RE = re.compile(rb'^\s*D[ E]?\s+(\S+)\s', re.M)
+
 
 def format_time(seconds):
     """
@@ -29,23 +42,68 @@ def format_time(seconds):
         The time formatted
     """
     mins, secs = divmod(seconds, 60)
-    return '{}:{:02d}'.format(int(mins), round(secs))
+    return f'{int(mins)}:{round(secs):02d}'
 
 
+@lru_cache(maxsize=4)
 def get_supported_formats(ffplay):
     """
-    Get formats supported by `ffplay`
+    Get formats supported by `ffplay`, cached per binary
     Args:
         ffplay: Path to ffplay binary
 
     Returns:
-        Generator of supported formats
+        Set of supported formats
     """
     proc = run([ffplay, '-formats'], stderr=DEVNULL, stdout=PIPE)
-    for line in proc.stdout.decode().splitlines():
-        line = line.strip().split()
-        if len(line) >= 3 and line[0].startswith('D'):
-            yield from line[1].split(',')
+    names = DEMUXER_RE.findall(proc.stdout)
+    return frozenset(chain.from_iterable(name.decode().split(',') for name in names))
+
+
+def cached_formats(ffplay, cache_file: Path):
+    """
+    Get formats supported by `ffplay`, cached on disk until the binary changes
+    Args:
+        ffplay: Path to ffplay binary
+        cache_file: path to the formats cache
+
+    Returns:
+        Set of supported formats
+    """
+    key = [ffplay, os.stat(ffplay).st_mtime_ns]
+    try:
+        cache = json.loads(cache_file.read_text())
+        if cache['key'] == key:
+            return frozenset(cache['formats'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    formats = get_supported_formats(ffplay)
+    try:
+        cache_file.write_text(json.dumps({'key': key, 'formats': sorted(formats)}))
+    except OSError:
+        pass
+    return formats
+
+
+def scan_dir(path: str, formats):
+    """
+    Scan a single directory for songs
+    Args:
+        path: path to the directory
+        formats: set of supported audio formats, in lower case
+    Returns:
+        Tuple of the song paths and the sub directory paths under path
+    """
+    songs = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_file():
+                if os.path.splitext(entry.name)[1][1:].lower() in formats:
+                    songs.append(entry.path)
+            elif entry.is_dir():
+                subdirs.append(entry.path)
+    return songs, subdirs
 
 
 def get_songs(path: Path, formats):
@@ -55,38 +113,97 @@ def get_songs(path: Path, formats):
         path: path to the music directory
         formats: set of supported audio formats
     Returns:
-        Generator of all song paths under path
+        Generator of all absolute song paths under path, as strings
+    """
+    stack = [os.path.abspath(path)]
+    while stack:
+        songs, subdirs = scan_dir(stack.pop(), formats)
+        yield from songs
+        stack.extend(subdirs)
+
+
+def get_songs_parallel(path: Path, formats, workers: int = 8):
+    """
+    Recursively get songs under path, scanning directories in a thread pool.
+    This overlaps the readdir round trips on slow or network filesystems.
+    Args:
+        path: path to the music directory
+        formats: set of supported audio formats
+        workers: number of directories to scan at once
+    Returns:
+        Generator of all absolute song paths under path, as strings
+    """
+    # Directories found but not submitted yet, only plain paths are kept for these
+    # so at most 2 * workers futures are alive however wide the tree is
+    todo = [os.path.abspath(path)]
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while todo or pending:
+            while todo and len(pending) < 2 * workers:
+                pending.add(pool.submit(scan_dir, todo.pop(), formats))
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                songs, subdirs = future.result()
+                yield from songs
+                todo.extend(subdirs)
+
+
+def get_ffprobe_duration(ffprobe, path) -> Optional[float]:
+    """
+    Get song duration from ffprobe
+
+    Args:
+        ffprobe: ffprobe binary
+        path: path to the song
+
+    Returns:
+        song duration in seconds, if any
     """
-    for sub in path.iterdir():
-        if sub.is_file():
-            if sub.suffix.lstrip('.') in formats:
-                yield sub.absolute()
-        elif sub.is_dir():
-            yield from get_songs(sub, formats)
+    proc = run(
+        [ffprobe, '-v', 'error', '-show_entries', 'format=duration',
+         '-of', 'default=nokey=1:noprint_wrappers=1', path],
+        stdout=PIPE, stderr=DEVNULL
+    )
+    try:
+        return float(proc.stdout)
+    except ValueError:
+        return None
 
 
-def get_ffmpeg_duration(ffmpeg, path) -> Optional[float]:
+def get_av_duration(path) -> Optional[float]:
     """
-    Get song duration from ffmpeg
+    Get song duration from its first audio stream with pyav
 
     Args:
-        ffmpeg: ffmpeg binary
         path: path to the song
 
     Returns:
         song duration in seconds, if any
     """
-    proc = run([ffmpeg, '-i', path], stdout=DEVNULL, stderr=PIPE)
-    err = proc.stderr.decode().splitlines()
-    for line in err:
-        line = line.strip().lower()
-        if line.startswith('duration'):
-            try:
-                time = line.split()[1].rstrip(',')
-                hour, minutes, seconds = time.split(':')
-                total = 60 * 60 * int(hour) + 60 * int(minutes) + float(seconds)
-            except Exception:
-                return None
-            else:
-                return total
+    try:
+        with av.open(path) as container:
+            stream = next((s for s in container.streams if s.type == 'audio'), None)
+            if stream is not None and stream.duration:
+                return float(stream.duration * stream.time_base)
+            if container.duration:
+                return container.duration / av.time_base
+    except av.error.FFmpegError:
+        pass
     return None
+
+
+def get_duration(ffprobe, path) -> Optional[float]:
+    """
+    Get song duration in process with pyav if it's installed,
+    otherwise from an ffprobe subprocess
+
+    Args:
+        ffprobe: ffprobe binary
+        path: path to the song
+
+    Returns:
+        song duration in seconds, if any
+    """
+    if av is not None:
+        return get_av_duration(path)
+    return get_ffprobe_duration(ffprobe, path)
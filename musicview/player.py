@@ -15,9 +15,7 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import curses
-from sqlite3 import connect
-from threading import Condition, Event, Lock, Thread
-from time import sleep
+from threading import Event, Lock, RLock, Thread
 
 from .db import iter_db
 from .misc import format_time
@@ -29,31 +27,36 @@ class Player:
     Music player class
     """
 
-    def __init__(self, data, name, ffplay, conn, controls, stdscr):
+    def __init__(self, ffplay, conn, controls, stdscr):
         """
         Args:
-            data: path to music library
-            name: name of the music library
             ffplay: ffplay binary
-            conn: database connection
+            conn: database connection, shared between threads under db_lock
             controls: curses controls keymap
             stdscr: curses screen
         """
         self.ffplay = ffplay
         self.controls = controls
-        self.data = data
-        self.name = name
         self.conn = conn
         self.stdscr = stdscr
 
         self.cur_song = None
+        self.meta_lines = []
+        # Last progress text and bar drawn, so unchanged rows are not redrawn
+        self.last_time = None
+        self.last_bar = None
 
         self.stopped = Event()
+        # Set while the current song is playing and not paused
+        self.playing = Event()
         self.db_lock = Lock()
-        self.cv = Condition()
+        # Held by every thread that draws, so a resize never reallocates a window mid draw
+        self.screen_lock = RLock()
 
         curses.curs_set(0)
         stdscr.clear()
+        # Only changes on KEY_RESIZE, no need to ask curses every tick
+        self.height, self.width = stdscr.getmaxyx()
 
         def get_y():
             running_y = 0
@@ -69,51 +72,51 @@ class Player:
             (ncol, ypos) in (y.send(h) for h, _ in zip(heights, y))
         )
 
-    @property
-    def height(self):
-        _height, _width = self.stdscr.getmaxyx()
-        return _height
-
-    @property
-    def width(self):
-        _height, _width = self.stdscr.getmaxyx()
-        return _width
-
     def ui(self):
         """UI control, meant to be ran in another thread"""
-        conn = connect(str(self.data / f'{self.name}.db'))
         while not self.stopped.is_set():
-            cmd = self.controls.get(self.stdscr.getkey())
+            key = self.stdscr.getkey()
+            if key == 'KEY_RESIZE':
+                self.resize()
+                continue
+            cmd = self.controls.get(key)
             if cmd == 'quit':
                 self.stopped.set()
                 if self.cur_song:
                     self.cur_song.stop()
-                self.stdscr.clear()
-                conn.close()
+                with self.screen_lock:
+                    self.stdscr.clear()
                 return
             elif not self.cur_song:
                 continue
             elif cmd == 'play/pause':
-                if self.cur_song.toggle_pause() is False:
-                    with self.cv:
-                        self.cv.notify()
-                self.display_playing()
+                if self.cur_song.toggle_pause():
+                    self.playing.clear()
+                else:
+                    self.playing.set()
+                with self.screen_lock:
+                    self.display_playing()
+                    curses.doupdate()
             elif cmd == 'skip':
                 self.cur_song.stop()
             elif cmd == 'toggle favourite':
                 with self.db_lock:
-                    self.cur_song.toggle_favourite(conn)
-                self.display_metadata()
+                    self.cur_song.toggle_favourite(self.conn)
+                with self.screen_lock:
+                    self.display_metadata()
+                    curses.doupdate()
 
     def progress(self):
         """ Progress bar control, meant to be ran in another thread"""
-        while not self.stopped.is_set():
-            with self.cv:
-                self.cv.wait_for(lambda: self.cur_song and not self.cur_song.paused)
+        while True:
+            self.playing.wait()
+            if self.stopped.is_set():
+                return
+            with self.screen_lock:
                 self.display_progress()
-                sleep(1)
-                if self.cur_song and self.cur_song.is_done:
-                    self.cur_song.stop()
+                curses.doupdate()
+            # Wake on the next whole second of playback, or early on quit
+            self.stopped.wait(1 - self.cur_song.time_played % 1)
 
     def start(self):
         """Start the music player """
@@ -126,51 +129,75 @@ class Player:
             if self.stopped.is_set():
                 break
             self.cur_song = song
+            self.meta_lines = song.meta.format()
             self.display()
             with self.cur_song.play(self.ffplay):
-                with self.cv:
-                    self.cv.notify()
+                self.playing.set()
+            self.playing.clear()
 
+        # Release the progress thread so it can see the player stopped
+        self.playing.set()
         ui.join()
         progress.join()
 
+    def resize(self):
+        """Fit the windows to the new terminal width and redraw everything"""
+        with self.screen_lock:
+            self.height, self.width = self.stdscr.getmaxyx()
+            self.stdscr.clear()
+            self.stdscr.noutrefresh()
+            for win in (self.playing_win, self.prog_win, self.meta_win):
+                win.resize(win.getmaxyx()[0], self.width)
+            if self.cur_song:
+                self.display()
+            else:
+                curses.doupdate()
+
     def display_progress(self):
         """Display the current seek time/bar of the current song"""
-        length = self.cur_song.meta.length
-        cur_time = self.cur_song.time_played
-        self.prog_win.addstr(
-            0, 1, '{}/{}'.format(format_time(cur_time), format_time(length))
-        )
-        bar_len = self.width - 4
-        prog = int(bar_len * cur_time // length) - 1
-        if prog < 0:
-            prog = 0
-        empty = bar_len - prog - 1
-        self.prog_win.addstr(1, 1, '|{}{}{}|'.format(prog * '=', '>', empty * ' '))
-        self.prog_win.refresh()
+        with self.screen_lock:
+            length = self.cur_song.meta.length
+            cur_time = self.cur_song.time_played
+            time_str = f'{format_time(cur_time)}/{format_time(length)}'
+            if time_str != self.last_time:
+                self.prog_win.addstr(0, 1, time_str)
+                self.last_time = time_str
+            bar_len = self.width - 4
+            # ffplay may outlive the stored length by a moment, keep the bar in bounds
+            prog = min(max(int(bar_len * cur_time // length) - 1, 0), bar_len - 1)
+            if (prog, bar_len) != self.last_bar:
+                empty = bar_len - prog - 1
+                self.prog_win.addstr(1, 1, f'|{prog * "="}>{empty * " "}|')
+                self.last_bar = (prog, bar_len)
+            self.prog_win.noutrefresh()
 
     def display_playing(self):
         """Display playing status of the current song"""
-        self.playing_win.addstr(0, 1, '[paused]' if self.cur_song.paused else '[playing]')
-        self.playing_win.refresh()
+        with self.screen_lock:
+            self.playing_win.addstr(0, 1, '[paused]' if self.cur_song.paused else '[playing]')
+            self.playing_win.noutrefresh()
 
     def display_metadata(self):
         """Display metadata infomation of the current song"""
-        self.meta_win.addstr(
-            0, 1,
-            '\n '.join(
-                self.cur_song.meta.format() +
-                ['Favourite: {}'.format(self.cur_song.fav),
-                 'Play count: {}'.format(self.cur_song.listen_count)]
+        with self.screen_lock:
+            self.meta_win.addstr(
+                0, 1,
+                '\n '.join(
+                    self.meta_lines +
+                    [f'Favourite: {self.cur_song.fav}',
+                     f'Play count: {self.cur_song.listen_count}']
+                )
             )
-        )
-        self.meta_win.refresh()
+            self.meta_win.noutrefresh()
 
     def display(self):
-        """ Display everything"""
-        self.meta_win.clear()
-        self.prog_win.clear()
-        self.playing_win.clear()
-        self.display_playing()
-        self.display_progress()
-        self.display_metadata()
+        """ Display everything in a single terminal update"""
+        with self.screen_lock:
+            self.meta_win.erase()
+            self.prog_win.erase()
+            self.playing_win.erase()
+            self.last_time = self.last_bar = None
+            self.display_playing()
+            self.display_progress()
+            self.display_metadata()
+            curses.doupdate()
@@ -14,15 +14,27 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import signal
-from collections import Iterable
 from subprocess import DEVNULL, Popen
-from time import time
+from time import monotonic
 from typing import NamedTuple, Optional
 
 from mutagen import File, MutagenError
+from mutagen.easymp4 import EasyMP4
+from mutagen.flac import FLAC
+from mutagen.mp3 import EasyMP3
 
-from .misc import format_time, get_ffmpeg_duration
+from .misc import format_time, get_duration
+
+# Parsers for common unambiguous extensions, skips mutagen's format sniffing
+EASY_PARSERS = {
+    'mp3': EasyMP3,
+    'flac': FLAC,
+    'm4a': EasyMP4,
+}
+# Display labels for every MetaData field after path
+LABELS = ('Title', 'Genre', 'Artist', 'Album', 'Length')
 
 
 class MetaData(NamedTuple):
@@ -34,27 +46,30 @@ class MetaData(NamedTuple):
     length: float
 
     @classmethod
-    def from_path(cls, ffmpeg: str, path: str) -> Optional['MetaData']:
+    def from_path(cls, ffprobe: str, path: str) -> Optional['MetaData']:
         """
         Get song metadata from path
         Args:
-            ffmpeg: ffmpeg binary
+            ffprobe: ffprobe binary
             path: path to the song
         Returns:
             Song metadata if able to find its length,
             otherwise None
         """
         get = lambda t, s: t.get(s, t.get(s.upper()))
+        parser = EASY_PARSERS.get(os.path.splitext(path)[1][1:].lower())
         try:
-            tags = File(path, easy=True) or {}
+            audio = parser(path) if parser else File(path, easy=True)
         except MutagenError:
-            tags = {}
+            audio = None
+        tags = audio or {}
         title = tag_to_str(get(tags, 'title'))
         genre = tag_to_str(get(tags, 'genre'))
         artist = tag_to_str(get(tags, 'artist'))
         album = tag_to_str(get(tags, 'album'))
-        length = tags.info.length if tags else None
-        length = length or get_ffmpeg_duration(ffmpeg, path)
+        # Untagged files are falsy but mutagen still knows their length
+        length = audio.info.length if audio is not None else None
+        length = length or get_duration(ffprobe, path)
         return cls(path, title, genre, artist, album, length) if length else None
 
     def format(self) -> list:
@@ -64,16 +79,11 @@ class MetaData(NamedTuple):
         Returns:
             the formatted text
         """
-        title = self.title or self.path
-        length = format_time(self.length)
-        lst = list(self[1:])
-        lst[0] = title
-        lst[-1] = length
-        return [
-            '{}: {}'.format(s, v) for s, v in
-            zip(['Title', 'Genre', 'Artist', 'Album', 'Length'], lst)
-            if v
-        ]
+        values = (
+            self.title or self.path, self.genre, self.artist, self.album,
+            format_time(self.length)
+        )
+        return [f'{s}: {v}' for s, v in zip(LABELS, values) if v]
 
 
 class Song:
@@ -105,12 +115,7 @@ class Song:
         if self.paused:
             return self._time_played
         else:
-            return self._time_played + time() - self.unpause_time
-
-    @property
-    def is_done(self) -> bool:
-        """Return wether this song is done playing"""
-        return self.time_played > self.meta.length
+            return self._time_played + monotonic() - self.unpause_time
 
     def toggle_favourite(self, conn):
         """
@@ -134,11 +139,17 @@ class Song:
         Returns:
             Process that's playing this song
         """
+        # Probing is left at its defaults, a tiny probesize fails on large ID3 tags
         self.playing_proc = Popen(
-            [ffplay, '-nodisp', '-autoexit', self.meta.path],
-            stderr=DEVNULL
+            [ffplay, '-nodisp', '-autoexit', '-loglevel', 'quiet',
+             '-fflags', 'nobuffer', '-flags', 'low_delay', self.meta.path],
+            stderr=DEVNULL,
+            # Python's own fds are non-inheritable already, and without close_fds
+            # Popen can use posix_spawn instead of fork + exec on every song change.
+            # Don't add preexec_fn/cwd/start_new_session here, they disable it too.
+            close_fds=False
         )
-        self.unpause_time = time()
+        self.unpause_time = monotonic()
         return self.playing_proc
 
     def toggle_pause(self) -> bool:
@@ -151,11 +162,11 @@ class Song:
         if self.paused:
             self.playing_proc.send_signal(signal.SIGCONT)
             self.paused = False
-            self.unpause_time = time()
+            self.unpause_time = monotonic()
         else:
             self.playing_proc.send_signal(signal.SIGSTOP)
             self.paused = True
-            self._time_played += time() - self.unpause_time
+            self._time_played += monotonic() - self.unpause_time
         return self.paused
 
     def stop(self):
@@ -174,12 +185,8 @@ def tag_to_str(tag):
         tag: the tag value
     Returns: the tag as a string
     """
-    if isinstance(tag, str):
-        res = tag.strip()
-    elif isinstance(tag, Iterable):
-        res = ','.join(tag).strip()
-    else:
-        res = None
-    if isinstance(res, str):
-        return res or None
+    if type(tag) is str:
+        return tag.strip() or None
+    if isinstance(tag, (list, tuple)):
+        return ','.join(tag).strip() or None
     return None
@@ -63,6 +63,7 @@ setup(
         'musicview',
     ],
     install_requires=reqs,
+    extras_require={'av': ['av']},
     package_data={'': ['README.rst', 'LICENSE', 'Pipfile', 'Pipfile.lock']},
     include_package_data=True,
     python_requires=">=3.6",
@@ -18,6 +18,11 @@ from contextlib import contextmanager
 from os import environ, walk
 from pathlib import Path
 
+try:
+    from tomllib import loads as toml_loads
+except ImportError:  # Python < 3.11
+    from toml import loads as toml_loads
+
 
 def get_files(p):
     for dir, __, fs in walk(p):
@@ -50,7 +55,8 @@ FULL_DATA = HAS_LEN / 'full_data'
 NON_FULL_DATA = HAS_LEN / 'non_full_data'
 SPAM = SONGS / 'spam'
 
-SONG_COUNT = file_count(SONGS)
+SONG_FILES = frozenset(get_files(SONGS))
+SONG_COUNT = len(SONG_FILES)
 HAS_LEN_COUNT = file_count(HAS_LEN)
 NO_LEN_COUNT = file_count(NO_LEN)
 FULL_DATA_COUNT = file_count(FULL_DATA)
@@ -0,0 +1,96 @@
+#  musicview, (re)discover your music library.
+#  Copyright (C) 2018 Peijun Ma
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+from copy import deepcopy
+from pathlib import Path
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import pytest
+import toml
+from click.testing import CliRunner
+
+from musicview import cli
+from musicview.cli import CONF_FILE, Ctx
+from tests import FULL_DATA
+
+# The package re-exports the cli group under the same name as its module
+CLI_MODULE = sys.modules['musicview.cli']
+SHM = Path('/dev/shm')
+
+# Ctx.setup writes the user's answer into Ctx.default_config, keep a pristine copy
+DEFAULT_CONFIG = deepcopy(Ctx.default_config)
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'slow: scans songs or runs the player, deselect with -m "not slow"'
+    )
+    # Keep test homes and library databases on tmpfs when it's there,
+    # tmp_path_factory reads basetemp when the tmpdir plugin is configured.
+    # A fresh directory per run, pytest empties basetemp so concurrent runs can't share one
+    if config.option.basetemp is None and os.access(SHM, os.W_OK):
+        config.option.basetemp = config.shm_basetemp = mkdtemp(
+            prefix='musicview-tests-', dir=SHM
+        )
+
+
+def pytest_unconfigure(config):
+    shm_basetemp = getattr(config, 'shm_basetemp', None)
+    if shm_basetemp:
+        rmtree(shm_basetemp, ignore_errors=True)
+
+
+@pytest.fixture(autouse=True)
+def config_home(monkeypatch, tmp_path):
+    """Give every test its own home, returns the default config home inside it"""
+    home = tmp_path / 'home'
+    monkeypatch.setattr(Path, 'home', lambda: home)
+    monkeypatch.setattr(CLI_MODULE, 'DEFAULT_CONFIG_HOME', home / '.musicview')
+    return home / '.musicview'
+
+
+@pytest.fixture(scope='session')
+def runner():
+    return CliRunner()
+
+
+@pytest.fixture(scope='session')
+def default_config_toml_bytes():
+    return toml.dumps(DEFAULT_CONFIG).encode()
+
+
+@pytest.fixture(scope='session')
+def no_update_toml_bytes():
+    conf = {**DEFAULT_CONFIG, 'general': {**DEFAULT_CONFIG['general'], 'check for updates': False}}
+    return toml.dumps(conf).encode()
+
+
+@pytest.fixture(scope='session')
+def full_data_snapshot(runner, default_config_toml_bytes, tmp_path_factory):
+    """A config home with the 'full data' library, built once and copied in by tests"""
+    snapshot = tmp_path_factory.mktemp('full_data') / '.musicview'
+    snapshot.mkdir()
+    (snapshot / CONF_FILE).write_bytes(default_config_toml_bytes)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(CLI_MODULE, 'DEFAULT_CONFIG_HOME', snapshot)
+        res = runner.invoke(cli, ['new', 'full data', str(FULL_DATA)])
+    assert res.exit_code == 0
+    return snapshot
@@ -14,86 +14,71 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from copy import deepcopy
+import json
+import urllib.error
+import urllib.request
+from contextlib import closing
+from io import BytesIO
 from pathlib import Path
+from shutil import copytree
 from sqlite3 import connect
 
-from tests import FULL_DATA, HERE, SONGS, SONG_COUNT, SPAM, export, get_files
-
-Path.home = lambda: Path(__file__).parent / 'test_home'
-from shutil import rmtree
-
 import pytest
 from click.testing import CliRunner
 
 from musicview import cli
-from musicview.cli import DEFAULT_CONFIG_HOME, CONF_FILE, Ctx
+from musicview.cli import CONF_FILE, UPDATE_CACHE
+from tests import FULL_DATA, SONG_COUNT, SONG_FILES, SONGS, SPAM, export, toml_loads
 
-import toml
+# Answers fed to the cli's prompts, as bytes so click doesn't encode them per invoke
+INPUT_YY = b'y\ry'
+INPUT_YN = b'y\rn'
+INPUT_N = b'n'
+INPUT_Y = b'y'
+INPUT_Q = b'q'
 
 
 class TestSetup:
-    tmp_dir = HERE / 'tmp'
-    conf = deepcopy(Ctx.default_config)
-    no_update_conf = deepcopy(conf)
-    no_update_conf['general']['check for updates'] = False
-
     @pytest.fixture()
-    def runner(self):
-        yield CliRunner()
-        try:
-            rmtree(Path.home())
-        except OSError:
-            pass
+    def env_home(self, tmp_path):
+        return tmp_path / 'musicview'
 
     @pytest.fixture()
-    def env_runner(self):
-        runner = CliRunner()
-        with export({'MUSICVIEW_CONFIG_HOME': str(self.tmp_dir)}):
+    def env_runner(self, runner: CliRunner, env_home):
+        with export({'MUSICVIEW_CONFIG_HOME': str(env_home)}):
             yield runner
-        rmtree(self.tmp_dir)
-
-    def test_setup_auto_update(self, runner: CliRunner):
-        result = runner.invoke(cli, ['list'], input='y\ry')
-        assert not result.exit_code
-        assert DEFAULT_CONFIG_HOME.is_dir()
-        with open(DEFAULT_CONFIG_HOME / 'musicview.toml') as f:
-            assert toml.load(f) == self.conf
 
-    def test_setup_no_update(self, runner: CliRunner):
-        result = runner.invoke(cli, ['list'], input='y\rn')
+    @pytest.mark.parametrize('inp, expected, use_env', [
+        (INPUT_YY, 'default_config_toml_bytes', False),
+        (INPUT_YN, 'no_update_toml_bytes', False),
+        (INPUT_YY, 'default_config_toml_bytes', True),
+    ], ids=['auto_update', 'no_update', 'envar'])
+    def test_setup(self, request, inp, expected, use_env):
+        runner = request.getfixturevalue('env_runner' if use_env else 'runner')
+        home = request.getfixturevalue('env_home' if use_env else 'config_home')
+        result = runner.invoke(cli, ['list'], input=inp)
         assert not result.exit_code
-        assert DEFAULT_CONFIG_HOME.is_dir()
-        with open(DEFAULT_CONFIG_HOME / 'musicview.toml') as f:
-            assert toml.load(f) == self.no_update_conf
+        assert home.is_dir()
+        assert (home / CONF_FILE).read_bytes() == request.getfixturevalue(expected)
 
-    def test_setup_envar(self, env_runner: CliRunner):
-        result = env_runner.invoke(cli, ['list'], input='y\ry')
-        assert not result.exit_code
-        assert self.tmp_dir.is_dir()
-        with open(self.tmp_dir / 'musicview.toml') as f:
-            assert toml.load(f) == self.conf
-
-    def test_setup_abort(self, runner: CliRunner):
-        result = runner.invoke(cli, ['list'], input='n')
+    def test_setup_abort(self, runner: CliRunner, config_home):
+        result = runner.invoke(cli, ['list'], input=INPUT_N)
         assert result.output.strip().endswith('Aborted!')
-        assert not DEFAULT_CONFIG_HOME.is_dir()
+        assert not config_home.is_dir()
 
-    def test_setup_abort_exists(self, env_runner: CliRunner):
-        self.tmp_dir.mkdir()
-        result = env_runner.invoke(cli, ['list'], input='n')
+    def test_setup_abort_exists(self, env_runner: CliRunner, env_home):
+        env_home.mkdir()
+        result = env_runner.invoke(cli, ['list'], input=INPUT_N)
         assert result.output.strip().endswith('Aborted!')
-        assert not list(self.tmp_dir.iterdir())
+        assert not list(env_home.iterdir())
 
 
 class TestEmpty:
 
-    @pytest.fixture()
-    def runner(self):
-        DEFAULT_CONFIG_HOME.mkdir(parents=True)
-        (DEFAULT_CONFIG_HOME / CONF_FILE).write_text(toml.dumps(Ctx.default_config))
-        yield CliRunner()
-        rmtree(Path.home())
+    @pytest.fixture(autouse=True)
+    def home(self, config_home, default_config_toml_bytes):
+        config_home.mkdir(parents=True)
+        (config_home / CONF_FILE).write_bytes(default_config_toml_bytes)
 
     def test_list(self, runner: CliRunner):
         result = runner.invoke(cli, ['list'])
@@ -101,50 +86,55 @@ class TestEmpty:
         assert not result.exit_code
         assert 'There are currently no music libraries!' in result.output
 
-    def test_new(self, runner: CliRunner):
+    @pytest.mark.slow
+    def test_new(self, runner: CliRunner, config_home):
         result = runner.invoke(cli, ['new', 'tmp', str(SONGS)])
         assert not result.exit_code
-        with open(DEFAULT_CONFIG_HOME / CONF_FILE) as f:
-            cfg = toml.load(f)
+        cfg = toml_loads((config_home / CONF_FILE).read_text())
         assert cfg['library paths'] == {'tmp': str(SONGS)}
-        with connect(str(DEFAULT_CONFIG_HOME / 'tmp.db')) as conn:
-            cur = conn.cursor()
-            cur.execute("SELECT path FROM library;")
-            res = cur.fetchall()
+        with closing(connect(str(config_home / 'tmp.db'))) as conn:
+            res = conn.execute('SELECT path FROM library;').fetchall()
+        assert len(res) == SONG_COUNT
+        assert {Path(p) for p, in res} == SONG_FILES
+
+    @pytest.mark.slow
+    def test_new_parallel_scan(self, runner: CliRunner, config_home):
+        with export({'MUSICVIEW_SCAN_WORKERS': '4'}):
+            result = runner.invoke(cli, ['new', 'tmp', str(SONGS)])
+        assert not result.exit_code
+        with closing(connect(str(config_home / 'tmp.db'))) as conn:
+            res = conn.execute('SELECT path FROM library;').fetchall()
         assert len(res) == SONG_COUNT
-        assert set(Path(p) for p, in res) == set(get_files(SONGS))
+        assert {Path(p) for p, in res} == SONG_FILES
+
+    def test_bad_scan_workers(self, runner: CliRunner):
+        with export({'MUSICVIEW_SCAN_WORKERS': 'many'}):
+            listed = runner.invoke(cli, ['list'])
+            created = runner.invoke(cli, ['new', 'tmp', str(SONGS)])
+        assert not listed.exit_code
+        assert created.exit_code
+        assert 'MUSICVIEW_SCAN_WORKERS must be an integer!' in created.output
 
     def test_new_fail(self, runner: CliRunner):
         result = runner.invoke(cli, ['new', 'tmp', str(SPAM)])
         assert result.exit_code
         assert f'Could not find any music files under "{SPAM}"!' in result.output
 
-    def test_update(self, runner: CliRunner):
-        result = runner.invoke(cli, ['update', 'foo'])
-        assert result.exit_code
-        assert 'Library "foo" does not exist!' in result.output
-
-    def test_delete(self, runner: CliRunner):
-        result = runner.invoke(cli, ['delete', 'spam'])
+    @pytest.mark.parametrize('cmd, name', [
+        ('update', 'foo'),
+        ('delete', 'spam'),
+        ('play', 'spam'),
+    ])
+    def test_missing_library(self, runner: CliRunner, cmd, name):
+        result = runner.invoke(cli, [cmd, name])
         assert result.exit_code
-        assert 'Library "spam" does not exist!' in result.output
-
-    def test_play(self, runner: CliRunner):
-        result = runner.invoke(cli, ['play', 'spam'])
-        assert result.exit_code
-        assert 'Library "spam" does not exist!' in result.output
+        assert f'Library "{name}" does not exist!' in result.output
 
 
 class TestOne:
-    @pytest.fixture()
-    def runner(self):
-        DEFAULT_CONFIG_HOME.mkdir(parents=True)
-        (DEFAULT_CONFIG_HOME / CONF_FILE).write_text(toml.dumps(Ctx.default_config))
-        runner = CliRunner()
-        res = runner.invoke(cli, ['new', 'full data', str(FULL_DATA)])
-        assert res.exit_code == 0
-        yield runner
-        rmtree(Path.home())
+    @pytest.fixture(autouse=True)
+    def home(self, config_home, full_data_snapshot):
+        copytree(full_data_snapshot, config_home)
 
     def test_list(self, runner: CliRunner):
         result = runner.invoke(cli, ['list'])
@@ -152,45 +142,116 @@ class TestOne:
         assert not result.exit_code
         assert 'full data' in result.output
 
-    def test_new(self, runner: CliRunner):
+    @pytest.mark.slow
+    def test_new(self, runner: CliRunner, config_home):
         result = runner.invoke(cli, ['new', 'tmp', str(SONGS)])
         assert not result.exit_code
-        with open(DEFAULT_CONFIG_HOME / CONF_FILE) as f:
-            cfg = toml.load(f)
+        cfg = toml_loads((config_home / CONF_FILE).read_text())
         assert cfg['library paths'] == {'full data': str(FULL_DATA), 'tmp': str(SONGS)}
-        with connect(str(DEFAULT_CONFIG_HOME / 'tmp.db')) as conn:
-            cur = conn.cursor()
-            cur.execute("SELECT path FROM library;")
-            res = cur.fetchall()
+        with closing(connect(str(config_home / 'tmp.db'))) as conn:
+            res = conn.execute('SELECT path FROM library;').fetchall()
         assert len(res) == SONG_COUNT
-        assert set(Path(p) for p, in res) == set(get_files(SONGS))
+        assert {Path(p) for p, in res} == SONG_FILES
 
-    def test_new_fail(self, runner: CliRunner):
+    def test_new_fail(self, runner: CliRunner, config_home):
         result = runner.invoke(cli, ['new', 'tmp', str(SPAM)])
         assert result.exit_code
         assert f'Could not find any music files under "{SPAM}"!' in result.output
-        with open(DEFAULT_CONFIG_HOME / CONF_FILE) as f:
-            cfg = toml.load(f)
+        cfg = toml_loads((config_home / CONF_FILE).read_text())
         assert cfg['library paths'] == {'full data': str(FULL_DATA)}
 
-    def test_new_exists(self, runner: CliRunner):
+    def test_new_exists(self, runner: CliRunner, config_home):
         result = runner.invoke(cli, ['new', 'full data', str(SPAM)])
         assert result.exit_code
         assert f'Library with name full data already exists!' in result.output
-        with open(DEFAULT_CONFIG_HOME / CONF_FILE) as f:
-            cfg = toml.load(f)
+        cfg = toml_loads((config_home / CONF_FILE).read_text())
         assert cfg['library paths'] == {'full data': str(FULL_DATA)}
 
+    @pytest.mark.slow
     def test_update(self, runner: CliRunner):
         result = runner.invoke(cli, ['update', 'full data'])
         assert result.exit_code == 0
         assert result.output.strip()
 
     def test_delete(self, runner: CliRunner):
-        result = runner.invoke(cli, ['delete', 'full data'], input='y')
+        result = runner.invoke(cli, ['delete', 'full data'], input=INPUT_Y)
         assert result.exit_code == 0
         assert 'full data deleted' in result.output.strip()
 
+    @pytest.mark.slow
     def test_play(self, runner: CliRunner):
-        result = runner.invoke(cli, ['play', 'full data'], input='q')
+        result = runner.invoke(cli, ['play', 'full data'], input=INPUT_Q)
         assert result.exit_code == -1
+
+
+class TestUpdateCheck:
+    ETAG = '"abc"'
+
+    @pytest.fixture(autouse=True)
+    def home(self, config_home, default_config_toml_bytes):
+        config_home.mkdir(parents=True)
+        (config_home / CONF_FILE).write_bytes(default_config_toml_bytes)
+
+    @pytest.fixture()
+    def requests(self, monkeypatch):
+        """Serve a newer version, or a 304 for its ETag, and record every request"""
+        requests = []
+
+        def urlopen(req, timeout):
+            requests.append(req)
+            if req.get_header('If-none-match') == self.ETAG:
+                raise urllib.error.HTTPError(req.full_url, 304, 'Not Modified', {}, None)
+            resp = BytesIO(b"__version__ = '999.0.0'\n")
+            resp.headers = {'ETag': self.ETAG}
+            return resp
+
+        monkeypatch.setattr(urllib.request, 'urlopen', urlopen)
+        return requests
+
+    def test_fetch(self, runner: CliRunner, config_home, requests):
+        result = runner.invoke(cli, ['list'])
+        assert not result.exit_code
+        assert 'New version (999.0.0) available!' in result.output
+        assert requests[0].get_header('If-none-match') is None
+        cache = json.loads((config_home / UPDATE_CACHE).read_text())
+        assert cache == {'etag': self.ETAG, 'version': '999.0.0'}
+
+    def test_not_modified(self, runner: CliRunner, config_home, requests):
+        cache = json.dumps({'etag': self.ETAG, 'version': '999.0.1'})
+        (config_home / UPDATE_CACHE).write_text(cache)
+        result = runner.invoke(cli, ['list'])
+        assert not result.exit_code
+        assert requests[0].get_header('If-none-match') == self.ETAG
+        assert 'New version (999.0.1) available!' in result.output
+        assert (config_home / UPDATE_CACHE).read_text() == cache
+
+    def test_partial_cache(self, runner: CliRunner, config_home, requests):
+        (config_home / UPDATE_CACHE).write_text(json.dumps({'etag': self.ETAG}))
+        result = runner.invoke(cli, ['list'])
+        assert not result.exit_code
+        assert requests[0].get_header('If-none-match') is None
+        assert 'New version (999.0.0) available!' in result.output
+
+    @pytest.mark.parametrize('body', [b'<html>Log in to continue</html>',
+                                      b"__version__ = '1.0.0rc1'\n"])
+    def test_bad_version(self, runner: CliRunner, config_home, monkeypatch, body):
+        def urlopen(req, timeout):
+            resp = BytesIO(body)
+            resp.headers = {'ETag': self.ETAG}
+            return resp
+
+        monkeypatch.setattr(urllib.request, 'urlopen', urlopen)
+        result = runner.invoke(cli, ['list'])
+        assert not result.exit_code
+        assert 'Could not check for updates.' in result.output
+        assert 'Traceback' not in result.output
+        assert not (config_home / UPDATE_CACHE).exists()
+
+    def test_read_error(self, runner: CliRunner, config_home, monkeypatch):
+        def urlopen(req, timeout):
+            raise ConnectionResetError
+
+        monkeypatch.setattr(urllib.request, 'urlopen', urlopen)
+        result = runner.invoke(cli, ['list'])
+        assert not result.exit_code
+        assert 'Could not check for updates.' in result.output
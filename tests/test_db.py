@@ -0,0 +1,40 @@
+#  musicview, (re)discover your music library.
+#  Copyright (C) 2018 Peijun Ma
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from threading import Lock
+from time import sleep
+
+from musicview import db
+from musicview.song import MetaData
+
+
+class TestScanLibrary:
+    def test_close_cancels_queued_probes(self, monkeypatch):
+        probed = []
+        lock = Lock()
+
+        def from_path(ffprobe, path):
+            sleep(0.01)
+            with lock:
+                probed.append(path)
+
+        monkeypatch.setattr(MetaData, 'from_path', from_path)
+        monkeypatch.setattr(db, 'SCAN_THREADS', 2)
+        scan = db.scan_library('ffprobe', range(db.CHUNK_SIZE))
+        next(scan)
+        scan.close()
+        # Only the probes already running when the generator closed may finish
+        assert len(probed) < 10
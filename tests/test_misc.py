@@ -0,0 +1,38 @@
+#  musicview, (re)discover your music library.
+#  Copyright (C) 2018 Peijun Ma
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from musicview.misc import get_songs, get_songs_parallel, scan_dir
+
+
+class TestScan:
+    @pytest.fixture()
+    def music(self, tmp_path):
+        for name in ('a.MP3', 'b.mp3', 'c.txt', 'sub/d.Mp3'):
+            (tmp_path / name).parent.mkdir(exist_ok=True)
+            (tmp_path / name).touch()
+        return tmp_path
+
+    def test_scan_dir_extension_case(self, music):
+        songs, subdirs = scan_dir(str(music), {'mp3'})
+        assert set(songs) == {str(music / 'a.MP3'), str(music / 'b.mp3')}
+        assert subdirs == [str(music / 'sub')]
+
+    @pytest.mark.parametrize('walk', [get_songs, get_songs_parallel])
+    def test_get_songs_extension_case(self, music, walk):
+        expected = {str(music / 'a.MP3'), str(music / 'b.mp3'), str(music / 'sub' / 'd.Mp3')}
+        assert set(walk(music, {'mp3'})) == expected